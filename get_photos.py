@@ -1,14 +1,30 @@
+from __future__ import annotations
+
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
 import os
 import json
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import subprocess
-from bs4 import BeautifulSoup
-from fractions import Fraction
-from dotenv import load_dotenv
-import piexif
+from html import unescape
 import logging
-from typing import Optional, List, Dict, Any
+from typing import TYPE_CHECKING, Optional, List, Dict, Any, Tuple
+
+# Heavier third-party modules are imported where they're used to keep startup fast
+if TYPE_CHECKING:
+    import aiohttp
+
+CSRF_TOKEN_RE = re.compile(rb'name="csrf-token"\s+content="([^"]+)"')
+
+# Number of newly processed photos to record before rewriting the manifest
+MANIFEST_FLUSH_INTERVAL = 50
 
 class TransparentClassroomClient:
     def __init__(self, email: str, password: str, school_id: int, child_id: int,
@@ -39,6 +55,19 @@ class TransparentClassroomClient:
 
         # Set instance variables
         self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=64,
+            max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.5',
+            # Only offer encodings urllib3 can decode (br/zstd need optional packages)
+            'Accept-Encoding': make_headers(accept_encoding=True)['accept-encoding'],
+        })
         self.school_id = school_id
         self.child_id = child_id
         self.school_lat = school_lat
@@ -48,36 +77,73 @@ class TransparentClassroomClient:
         self.photo_dir = photo_dir
         self.cache_timeout = cache_timeout
 
+        # Persistent exiftool process, started on first use
+        import exiftool
+        self._exiftool = exiftool.ExifToolHelper(common_args=['-G', '-n', '-overwrite_original'])
+
         # Create necessary directories
         os.makedirs(cache_dir, exist_ok=True)
         os.makedirs(photo_dir, exist_ok=True)
 
+        # Posts cache, shared by the page-fetching threads
+        self._db = sqlite3.connect(f"{cache_dir}/cache.db", check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages '
+                         '(page INTEGER PRIMARY KEY, fetched_at REAL, etag TEXT, last_modified TEXT, body BLOB)')
+        self._db_lock = threading.Lock()
+
+        # Photos already processed by previous runs
+        self._manifest_file = f"{cache_dir}/manifest.json"
+        self._manifest = self._load_manifest()
+        self._manifest_pending = 0
+
+        # The school location never changes, so build the GPS tags once
+        self._gps_tags = {
+            'GPS:GPSLatitude': abs(school_lat),
+            'GPS:GPSLatitudeRef': 'S' if school_lat < 0 else 'N',
+            'GPS:GPSLongitude': abs(school_lng),
+            'GPS:GPSLongitudeRef': 'W' if school_lng < 0 else 'E',
+        }
+
         # Initialize session
         self._login(email, password)
 
+    def __enter__(self) -> 'TransparentClassroomClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Stop exiftool if it was started, save the manifest and close the cache"""
+        if self._exiftool.running:
+            self._exiftool.terminate()
+        self._flush_manifest()
+        self._db.close()
+
     def _login(self, email: str, password: str) -> bool:
         """Login to Transparent Classroom"""
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Content-Type': 'application/x-www-form-urlencoded',
-        }
-
         try:
             # Get CSRF token
             login_url = 'https://www.transparentclassroom.com/souls/sign_in'
-            response = self.session.get(login_url, headers=headers)
+            response = self.session.get(login_url)
             response.raise_for_status()
 
-            soup = BeautifulSoup(response.text, 'html.parser')
-            csrf_token = soup.find('meta', {'name': 'csrf-token'})
+            match = CSRF_TOKEN_RE.search(response.content)
+            if match:
+                csrf_token = unescape(match.group(1).decode())
+            else:
+                # Fall back to parsing the page if the markup doesn't match
+                from bs4 import BeautifulSoup, SoupStrainer
+
+                soup = BeautifulSoup(response.text, 'lxml',
+                                     parse_only=SoupStrainer('meta', {'name': 'csrf-token'}))
+                meta = soup.find('meta', {'name': 'csrf-token'})
+
+                if not meta:
+                    raise ValueError("Could not find CSRF token")
 
-            if not csrf_token:
-                raise ValueError("Could not find CSRF token")
+                csrf_token = meta['content']
 
             login_data = {
-                'authenticity_token': csrf_token['content'],
+                'authenticity_token': csrf_token,
                 'soul[login]': email,
                 'soul[password]': password,
                 'soul[remember_me]': '0',
@@ -85,7 +151,7 @@ class TransparentClassroomClient:
             }
 
             # Perform login
-            response = self.session.post(login_url, data=login_data, headers=headers)
+            response = self.session.post(login_url, data=login_data)
             response.raise_for_status()
 
             if 'You need to sign in' in response.text:
@@ -98,154 +164,317 @@ class TransparentClassroomClient:
             self.logger.error(f"Login failed: {str(e)}")
             raise
 
-    def _get_cached_data(self, cache_file: str) -> Optional[Dict]:
-        """Get data from cache if valid"""
-        if os.path.exists(cache_file):
-            cache_age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(cache_file))
-            if cache_age.total_seconds() <= self.cache_timeout:
-                self.logger.info(f"Loading cached data from {cache_file}")
-                with open(cache_file, 'r') as file:
-                    return json.load(file)
-            else:
-                self.logger.info(f"Cache expired, removing {cache_file}")
-                os.remove(cache_file)
-        return None
+    def _get_cached_data(self, page: int) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """Get a cached page and whether it is still within the cache timeout"""
+        with self._db_lock:
+            row = self._db.execute(
+                'SELECT fetched_at, etag, last_modified, body FROM pages WHERE page = ?', (page,)
+            ).fetchone()
+
+        if row is None:
+            return None, False
+
+        fetched_at, etag, last_modified, body = row
+        entry = {'etag': etag, 'last_modified': last_modified, 'body': json.loads(body)}
+        return entry, time.time() - fetched_at <= self.cache_timeout
+
+    def _set_cached_data(self, page: int, etag: Optional[str], last_modified: Optional[str],
+                         body: bytes) -> None:
+        """Store a page in the cache"""
+        with self._db_lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO pages (page, fetched_at, etag, last_modified, body) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (page, time.time(), etag, last_modified, body)
+            )
+
+    def _touch_cached_data(self, page: int) -> None:
+        """Mark a cached page as freshly validated"""
+        with self._db_lock, self._db:
+            self._db.execute('UPDATE pages SET fetched_at = ? WHERE page = ?', (time.time(), page))
 
     def get_posts(self, page: int = 1) -> Optional[List[Dict[str, Any]]]:
         """Get posts for the specified page"""
-        cache_file = f"{self.cache_dir}/cache_page_{page}.json"
-
         # Try cache first
-        cached_data = self._get_cached_data(cache_file)
-        if cached_data:
-            return cached_data
+        cached, fresh = self._get_cached_data(page)
+        if fresh and cached['body']:
+            self.logger.info(f"Loading cached data for page {page}")
+            return cached['body']
+
+        # Revalidate an expired entry instead of downloading it again
+        headers = {}
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
 
         # Make API request
         url = f"https://www.transparentclassroom.com/s/{self.school_id}/children/{self.child_id}/posts.json"
 
         try:
-            response = self.session.get(url, params={"locale": "en", "page": page})
+            response = self.session.get(url, params={"locale": "en", "page": page}, headers=headers)
             response.raise_for_status()
 
-            # Cache response
-            with open(cache_file, 'w') as file:
-                json.dump(response.json(), file, indent=4, sort_keys=True)
+            if response.status_code == 304:
+                self.logger.info(f"Cache not modified, refreshing page {page}")
+                self._touch_cached_data(page)
+                return cached['body']
 
-            return response.json()
+            data = response.json()
+
+            # Cache the raw response body along with its validators
+            self._set_cached_data(page, response.headers.get('ETag'),
+                                  response.headers.get('Last-Modified'), response.content)
+
+            return data
 
         except requests.exceptions.RequestException as e:
             self.logger.error(f"Failed to get posts: {str(e)}")
             return None
 
+    def set_metadata(self, image_path: str, title: str, creator: str, created_at: datetime) -> None:
+        """Set EXIF, GPS and IPTC metadata in one exiftool write"""
+        import exiftool
+
+        try:
+            self._exiftool.set_tags([image_path], tags={
+                'EXIF:ImageDescription': title,
+                'EXIF:DateTimeOriginal': created_at.strftime("%Y:%m:%d %H:%M:%S"),
+                **self._gps_tags,
+                'IPTC:ObjectName': title,
+                'IPTC:By-line': creator,
+                'IPTC:Keywords': self.school_keywords,
+            })
+        except exiftool.exceptions.ExifToolException as e:
+            self.logger.error(f"Failed to set metadata: {str(e)}")
+            raise
+
     @staticmethod
-    def _to_deg(value: float, loc: List[str]) -> tuple:
-        """Convert decimal coordinates to degrees, minutes, seconds"""
-        loc_value = loc[1] if value < 0 else loc[0]
-        abs_value = abs(value)
-        deg = int(abs_value)
-        t1 = (abs_value - deg) * 60
-        min = int(t1)
-        sec = round((t1 - min) * 60, 5)
-        return deg, min, sec, loc_value
+    def _strip_html(html: str) -> str:
+        """Extract the plain text from an HTML fragment"""
+        from selectolax.lexbor import LexborHTMLParser
+
+        return ' '.join(LexborHTMLParser(html).text().split())
+
+    def _load_manifest(self) -> Dict[str, str]:
+        """Load the manifest of processed photos"""
+        try:
+            with open(self._manifest_file, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            self.logger.warning(f"Ignoring corrupt manifest {self._manifest_file}: {str(e)}")
+            return {}
+
+    def _save_manifest(self) -> None:
+        """Atomically write the manifest of processed photos"""
+        tmp_file = f"{self._manifest_file}.tmp"
+        with open(tmp_file, 'w') as file:
+            json.dump(self._manifest, file)
+        os.replace(tmp_file, self._manifest_file)
+
+    def _flush_manifest(self) -> None:
+        """Write the manifest if any photos were recorded since the last write"""
+        if self._manifest_pending:
+            self._save_manifest()
+            self._manifest_pending = 0
+
+    def _record_processed(self, photo_data: Dict[str, Any]) -> None:
+        """Record a processed photo, writing the manifest every few photos"""
+        self._manifest[str(photo_data['id'])] = self._photo_version(photo_data)
+        self._manifest_pending += 1
+        if self._manifest_pending >= MANIFEST_FLUSH_INTERVAL:
+            self._flush_manifest()
 
     @staticmethod
-    def _change_to_rational(number: float) -> tuple:
-        """Convert number to rational for EXIF"""
-        f = Fraction(str(number))
-        return (f.numerator, f.denominator)
+    def _photo_version(photo_data: Dict[str, Any]) -> str:
+        """Get the value that changes whenever a photo is updated"""
+        return photo_data.get('updated_at') or photo_data['created_at']
+
+    def _is_processed(self, photo_data: Dict[str, Any]) -> bool:
+        """Check whether a photo is unchanged since it was last processed"""
+        photo_id = photo_data['id']
+        key = str(photo_id)
+        return (key in self._manifest
+                and self._manifest[key] == self._photo_version(photo_data)
+                and self._is_downloaded(self._image_path(photo_id)))
 
-    def set_iptc_metadata(self, image_path: str, title: str, creator: str) -> None:
-        """Set IPTC metadata using exiftool"""
+    @staticmethod
+    def _is_downloaded(image_path: str) -> bool:
+        """Check whether a photo exists on disk and isn't empty"""
         try:
-            command = [
-                'exiftool',
-                f'-IPTC:ObjectName={title}',
-                f'-IPTC:By-line={creator}',
-                f'-IPTC:Keywords={self.school_keywords}',
-                image_path
-            ]
-            subprocess.run(command, check=True)
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"Failed to set IPTC metadata: {str(e)}")
+            return os.stat(image_path).st_size > 0
+        except FileNotFoundError:
+            return False
+
+    def _image_path(self, photo_id: Any) -> str:
+        """Get the local path for a photo"""
+        return f"{self.photo_dir}/{photo_id}_max.jpg"
+
+    def embed_metadata(self, photo_data: Dict[str, Any]) -> None:
+        """Embed metadata into an already downloaded photo"""
+        if self._is_processed(photo_data):
+            return
+
+        try:
+            description = self._strip_html(photo_data['html'])
+            creator = self._strip_html(photo_data['author'])
+            created_at = datetime.fromisoformat(photo_data['created_at'])
+            photo_id = photo_data['id']
+
+            image_path = self._image_path(photo_id)
+
+            # Set EXIF, GPS and IPTC metadata
+            self.set_metadata(image_path, description, creator, created_at)
+
+            # Set file timestamps
+            timestamp = created_at.timestamp()
+            os.utime(image_path, (timestamp, timestamp))
+
+            # Record the photo so later runs can skip it
+            self._record_processed(photo_data)
+
+            self.logger.info(f"Successfully processed photo {photo_id}")
+
+        except Exception as e:
+            self.logger.error(f"Failed to process photo {photo_data.get('id', 'unknown')}: {str(e)}")
             raise
 
     def download_and_embed_metadata(self, photo_data: Dict[str, Any]) -> None:
         """Download photo and embed metadata"""
+        if self._is_processed(photo_data):
+            return
+
         try:
             photo_url = photo_data['original_photo_url']
-            description = BeautifulSoup(photo_data['html'], 'html.parser').get_text()
-            creator = BeautifulSoup(photo_data['author'], 'html.parser').get_text()
-            created_at = datetime.fromisoformat(photo_data['created_at'].rstrip("Z"))
-            photo_id = photo_data['id']
-
-            image_path = f"{self.photo_dir}/{photo_id}_max.jpg"
+            image_path = self._image_path(photo_data['id'])
 
             # Download if doesn't exist
-            if not os.path.exists(image_path):
-                response = self.session.get(photo_url)
-                response.raise_for_status()
+            if not self._is_downloaded(image_path):
+                tmp_path = f"{image_path}.part"
+                with self.session.get(photo_url, stream=True, timeout=30) as response:
+                    response.raise_for_status()
 
-                with open(image_path, 'wb') as file:
-                    file.write(response.content)
+                    with open(tmp_path, 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=65536):
+                            file.write(chunk)
+                os.replace(tmp_path, image_path)
 
-            # Update EXIF metadata
-            exif_dict = piexif.load(image_path)
+        except Exception as e:
+            self.logger.error(f"Failed to download photo {photo_data.get('id', 'unknown')}: {str(e)}")
+            raise
 
-            # Basic EXIF data
-            exif_dict['0th'][piexif.ImageIFD.ImageDescription] = description.encode('utf-8')
-            exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = created_at.strftime("%Y:%m:%d %H:%M:%S").encode('utf-8')
+        self.embed_metadata(photo_data)
 
-            # GPS data
-            lat_deg = self._to_deg(self.school_lat, ["N", "S"])
-            lng_deg = self._to_deg(self.school_lng, ["E", "W"])
+    def _cookie_jar(self) -> aiohttp.CookieJar:
+        """Copy the logged-in session cookies into an aiohttp cookie jar"""
+        import aiohttp
+        from yarl import URL
 
-            exif_dict["GPS"] = {
-                piexif.GPSIFD.GPSLatitudeRef: lat_deg[3].encode('utf-8'),
-                piexif.GPSIFD.GPSLatitude: tuple(self._change_to_rational(x) for x in lat_deg[:3]),
-                piexif.GPSIFD.GPSLongitudeRef: lng_deg[3].encode('utf-8'),
-                piexif.GPSIFD.GPSLongitude: tuple(self._change_to_rational(x) for x in lng_deg[:3]),
-            }
+        jar = aiohttp.CookieJar()
+        for cookie in self.session.cookies:
+            jar.update_cookies({cookie.name: cookie.value},
+                               URL(f"https://{cookie.domain.lstrip('.')}/"))
+        return jar
 
-            # Write EXIF data
-            exif_bytes = piexif.dump(exif_dict)
-            piexif.insert(exif_bytes, image_path)
+    async def _fetch_one(self, session: aiohttp.ClientSession, photo_data: Dict[str, Any]) -> None:
+        """Stream a single photo to disk if it doesn't exist yet"""
+        import aiofiles
 
-            # Set IPTC metadata
-            self.set_iptc_metadata(image_path, description, creator)
+        try:
+            photo_url = photo_data['original_photo_url']
+            image_path = self._image_path(photo_data['id'])
 
-            # Set file timestamps
-            os.utime(image_path, (created_at.timestamp(), created_at.timestamp()))
+            if self._is_downloaded(image_path):
+                return
 
-            self.logger.info(f"Successfully processed photo {photo_id}")
+            # Write to a temporary file so an interrupted download is never
+            # mistaken for a complete photo on the next run
+            tmp_path = f"{image_path}.part"
+            async with session.get(photo_url) as response:
+                response.raise_for_status()
+                async with aiofiles.open(tmp_path, 'wb') as file:
+                    async for chunk in response.content.iter_chunked(65536):
+                        await file.write(chunk)
+            os.replace(tmp_path, image_path)
 
         except Exception as e:
-            self.logger.error(f"Failed to process photo {photo_data.get('id', 'unknown')}: {str(e)}")
+            self.logger.error(f"Failed to download photo {photo_data.get('id', 'unknown')}: {str(e)}")
             raise
 
-    def crawl_photos(self) -> List[Dict[str, Any]]:
-        """Crawl all photos"""
+    async def _process_one(self, session: aiohttp.ClientSession, executor: ThreadPoolExecutor,
+                           photo_data: Dict[str, Any]) -> None:
+        """Download a photo, then embed its metadata off the event loop"""
+        await self._fetch_one(session, photo_data)
+        await asyncio.get_running_loop().run_in_executor(executor, self.embed_metadata, photo_data)
+
+    async def _process_all(self, photos: List[Dict[str, Any]]) -> None:
+        """Download all photos concurrently, embedding metadata as each one lands"""
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=16, limit_per_host=8)
+        # Per-operation limits only: a total timeout would also count time spent
+        # queued for a pooled connection and fail photos that never started
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+        # A single worker: exiftool runs as one persistent process and the
+        # manifest is only updated from the embedding thread
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                 cookie_jar=self._cookie_jar()) as session:
+                    async with asyncio.TaskGroup() as tg:
+                        for photo_data in photos:
+                            tg.create_task(self._process_one(session, executor, photo_data))
+        finally:
+            # Keep whatever finished, even if the run failed part way
+            self._flush_manifest()
+
+    def pending_photos(self, posts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Get the photos that still need processing, one per photo id"""
+        unique = {}
+        for photo_data in posts:
+            if 'original_photo_url' in photo_data:
+                unique.setdefault(photo_data['id'], photo_data)
+
+        pending = [p for p in unique.values() if not self._is_processed(p)]
+        self.logger.info(f"{len(pending)} photos to process, {len(unique) - len(pending)} unchanged")
+        return pending
+
+    def crawl_photos(self, window: int = 8) -> List[Dict[str, Any]]:
+        """Crawl all photos, fetching pages in concurrent windows"""
         photos = []
-        page = 0
+        page = 1
+        done = False
+
+        with ThreadPoolExecutor(max_workers=window) as executor:
+            while not done:
+                futures = [executor.submit(self.get_posts, p) for p in range(page, page + window)]
+
+                for offset, future in enumerate(futures):
+                    posts = future.result()
 
-        while True:
-            page += 1
-            posts = self.get_posts(page=page)
+                    if not posts:
+                        done = True
+                        break
 
-            if not posts:
-                break
+                    photos.extend(posts)
+                    self.logger.info(f"Retrieved page {page + offset} with {len(posts)} posts")
 
-            photos.extend(posts)
-            self.logger.info(f"Retrieved page {page} with {len(posts)} posts")
+                page += window
 
         return photos
 
-def main():
+async def main_async():
     # Load environment variables
+    from dotenv import load_dotenv
     load_dotenv()
 
     # Initialize client
     try:
-        client = TransparentClassroomClient(
+        with TransparentClassroomClient(
             email=os.getenv('TC_EMAIL'),
             password=os.getenv('TC_PASSWORD'),
             school_id=int(os.getenv('SCHOOL', 0)),
@@ -253,20 +482,24 @@ def main():
             school_lat=float(os.getenv('SCHOOL_LAT', 0)),
             school_lng=float(os.getenv('SCHOOL_LNG', 0)),
             school_keywords=os.getenv('SCHOOL_KEYWORDS', '')
-        )
+        ) as client:
+            # Crawl photos
+            photos = client.crawl_photos()
 
-        # Crawl photos
-        photos = client.crawl_photos()
+            # Only queue photos that changed since the last run
+            pending = client.pending_photos(photos)
 
-        # Process each photo
-        for photo_data in photos:
-            client.download_and_embed_metadata(photo_data)
+            # Download photos and embed metadata
+            await client._process_all(pending)
 
-        print(f"Successfully processed {len(photos)} photos")
+        print(f"Successfully processed {len(pending)} photos")
 
     except Exception as e:
         logging.error(f"Application failed: {str(e)}")
         raise
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()